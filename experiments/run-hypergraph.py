@@ -35,6 +35,8 @@ parser.add_argument('-l', '--loops', type=float, default=0.0, metavar='WEIGHT',
     help='Add self loop edges with the given weight. If loops are already present, their weight is increased')
 parser.add_argument('--partial-eigs', action='store_true', default=False,
     help='Only compute the required number of eigenvalues instead of a full decomposition')
+parser.add_argument('--spectral-cache', action='store_true', default=False,
+    help='Store computed eigendecompositions in the data directory and reuse them in later calls')
 parser.add_argument('--hidden', nargs='*', type=int, default=[32], metavar='H', 
     help='Hidden layer widths')
 parser.add_argument('--dropout', type=float, default=0.5, metavar='RATE',
@@ -97,7 +99,8 @@ tic = timer()
 
 setup_transform = pinvgcn.hypergraphs.HypergraphSpectralSetup(rank=args.rank, 
                                                               partial_eigs=args.partial_eigs,
-                                                              eig_tol=1e-3)
+                                                              eig_tol=1e-3,
+                                                              cache_dir=os.path.join(data_dir, 'spectral_cache') if args.spectral_cache else None)
 if args.repeat_setup:
     orig_data = data
 else:
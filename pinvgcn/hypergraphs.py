@@ -1,9 +1,14 @@
 
 import numpy as np
+import scipy.linalg
 import scipy.sparse as sp
 import os
 import shutil
 import pickle
+import hashlib
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torch_geometric.data import download_url
@@ -50,22 +55,56 @@ class HypergraphSpectralSetup(object):
     only the relevant eigenvalues are computed, which might negatively impact
     runtime for small systems. In the partial case, `eig_tol` is the tolerance
     for the eigenvalue computation. `eig_threshold` determines which 
-    eigenvalues are treated as zero.
-    This function currently expects the hypergraph incidence to be stored in
-    data.x as a dense tensor.
+    eigenvalues are treated as zero. If `cache_dir` is not None, computed
+    decompositions are stored there, keyed by the incidence, its scaling, and
+    the decomposition parameters, and loaded instead of being recomputed.
+    The hypergraph is taken from data.hyperedge_index if given, otherwise the
+    incidence matrix is expected to be stored in data.x as a dense tensor.
     """
     
-    def __init__(self, rank=None, eig_tol=0, eig_threshold=1e-6, partial_eigs=False):
+    def __init__(self, rank=None, eig_tol=0, eig_threshold=1e-6, partial_eigs=False, cache_dir=None):
         self.rank = rank
         self.eig_tol = eig_tol
         self.eig_threshold = eig_threshold
         self.partial_eigs = partial_eigs
+        self.cache_dir = cache_dir
         
     def __call__(self, data):
-        inc = normalized_incidence(data, sparse=self.partial_eigs)
-    
-        w, U = hypergraph_laplacian_decomposition(inc, num_ev=None if self.rank is None else self.rank+1, 
-                                                  partial_svd=self.partial_eigs, partial_tol=self.eig_tol)
+        inc, row_scale, col_scale = incidence_factors(data)
+        num_ev = None if self.rank is None else self.rank+1
+        
+        cache_file = None
+        if self.cache_dir is not None:
+            key = hashlib.sha1(repr((num_ev, self.partial_eigs, self.eig_tol, inc.shape)).encode())
+            for arr in [inc.indptr, inc.indices, inc.data, row_scale, col_scale]:
+                key.update(arr.tobytes())
+            cache_file = os.path.join(self.cache_dir, '{}_{}.npz'.format(
+                data.name if 'name' in data else 'hypergraph', key.hexdigest()))
+        
+        w = U = None
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cache:
+                    w, U = cache['w'], cache['U']
+            except (OSError, EOFError, zipfile.BadZipFile, KeyError, ValueError):
+                # unreadable cache file, recompute and replace it below
+                w = U = None
+        
+        if w is None:
+            w, U = hypergraph_laplacian_decomposition(inc, num_ev=num_ev, partial_svd=self.partial_eigs, 
+                                                      partial_tol=self.eig_tol,
+                                                      row_scale=row_scale, col_scale=col_scale)
+            if cache_file is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # write to a temporary file first so that readers never see a partial file
+                fd, tmp_file = tempfile.mkstemp(suffix='.npz.tmp', dir=self.cache_dir)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.savez_compressed(f, w=w, U=U)
+                    os.replace(tmp_file, cache_file)
+                except BaseException:
+                    os.remove(tmp_file)
+                    raise
     
         setup_spectral_data(data, w, U, threshold=self.eig_threshold, max_rank=self.rank)
     
@@ -97,29 +136,28 @@ class MushroomDataset(HypergraphDataset):
         download_url(self.url, self.raw_dir)
         
     def process(self):
-        raw = []
-        with open(os.path.join(self.raw_dir, self.raw_file_names), 'r') as f:
-            for line in f:
-                raw.append(line[:-1].split(','))
-                
-        raw = np.array(raw)
-        labels = (raw[:,0] == 'e').astype(int)
+        import pandas as pd
+        
+        raw = pd.read_csv(os.path.join(self.raw_dir, self.raw_file_names), header=None, 
+                          dtype='category', keep_default_na=False, engine='c')
+        labels = (raw[0] == 'e').to_numpy().astype(np.int64)
         
-        inc_list = []
+        encoded = []
         for i in range(1, raw.shape[1]):
-            col = raw[:,i]
-            values = np.unique(col)
-            if any([v.startswith('?') for v in values]):
+            values = raw[i].cat.categories
+            if values.str.startswith('?').any():
                 continue
-            
-            for v in values:
-                edge = (col == v)
-                print(' - Hyperedge size for attribute #{} == {}:  {}'.format(i, v, edge.sum()))
-                inc_list.append(edge)
+            encoded.append((len(values), raw[i].cat.codes.to_numpy()))
+        
+        incidence = np.empty((raw.shape[0], sum(k for k, _ in encoded)), dtype=np.uint8, order='F')
+        offset = 0
+        for num_values, codes in encoded:
+            # one hyperedge per attribute value, written into its column slice
+            np.equal(codes[:,np.newaxis], np.arange(num_values, dtype=codes.dtype), out=incidence[:, offset:offset+num_values])
+            offset += num_values
                 
-        incidence = np.array(inc_list, dtype=np.float).T
         print(' - Mushroom incidence shape: {}'.format(incidence.shape))
-    
+        
         self.save_hypergraph(incidence, labels)
         
 
@@ -145,36 +183,47 @@ class CovertypeDataset(HypergraphDataset):
         os.system('gunzip -f ' + os.path.join(self.raw_dir, self.raw_file_names + '.gz'))
         
     def process(self):
-        raw_attributes, labels = [], []
-        with open(os.path.join(self.raw_dir, self.raw_file_names), 'r') as f:
-            for line in f:
-                values = line.split(',')
-                raw_attributes.append([int(v) for v in values[:-1]])
-                labels.append(int(values[-1]))
-        raw_attributes = np.array(raw_attributes)
-        labels = np.array(labels)
+        import pandas as pd
+        
+        raw = pd.read_csv(os.path.join(self.raw_dir, self.raw_file_names), header=None, 
+                          dtype=np.int32, engine='c').to_numpy()
+        raw_attributes = raw[:,:-1]
+        labels = raw[:,-1].astype(np.int64)
+        
+        num_bins = self.num_bins
+        # column-major, so that each hyperedge is a contiguous block of memory
+        incidence = np.empty((raw_attributes.shape[0], 10*num_bins + raw_attributes.shape[1] - 10), 
+                             dtype=np.uint8, order='F')
         
-        inc_list = []
-        for attr in range(10):
+        def bin_attribute(attr):
             col = raw_attributes[:,attr]
             colmin = col.min()
             colmax = col.max()
-            print(' - Continuous attribute #{}: min {}, max {}'.format(attr, colmin, colmax))
             
-            b = colmin
-            for i in range(self.num_bins):
-                a = b
-                b = colmax+1 if i==self.num_bins-1 else colmin + (colmax-colmin)*(i+1)/self.num_bins
-                inc_list.append((col >= a) & (col < b))
+            # inner bin edges, the outer bins are bounded by colmin and colmax
+            edges = colmin + (colmax-colmin)*np.arange(1, num_bins)/num_bins
+            bins = np.digitize(col, edges)
+            np.equal(bins[:,np.newaxis], np.arange(num_bins), out=incidence[:, attr*num_bins : (attr+1)*num_bins])
+            return colmin, colmax
+        
+        # numpy releases the GIL in these kernels, so threads suffice and the
+        # attribute array is shared instead of being pickled
+        with ThreadPoolExecutor() as executor:
+            ranges = list(executor.map(bin_attribute, range(10)))
+        for attr, (colmin, colmax) in enumerate(ranges):
+            print(' - Continuous attribute #{}: min {}, max {}'.format(attr, colmin, colmax))
         
-        incidence = np.hstack((np.array(inc_list, dtype=int).T, raw_attributes[:,10:]))
+        incidence[:, 10*num_bins:] = raw_attributes[:,10:]
         print(' - Full Covertype incidence shape: {}'.format(incidence.shape))
         
         if self.classes is not None:
             
-            mask = [l in self.classes for l in labels]
-            class_map = {orig: new for new, orig in enumerate(self.classes)}
-            labels = [class_map[l] for l in labels[mask]]
+            # lookup table from original to new labels, -1 for excluded classes
+            class_map = np.full(max(labels.max(), max(self.classes)) + 1, -1, dtype=np.int64)
+            class_map[self.classes] = np.arange(len(self.classes))
+            labels = class_map[labels]
+            mask = labels >= 0
+            labels = labels[mask]
             
             incidence = incidence[mask, :]
             edge_deg = incidence.sum(axis=0)
@@ -184,7 +233,7 @@ class CovertypeDataset(HypergraphDataset):
             incidence = incidence[:, mask]
             
             print(' - Partial incidence shape for classes {}: {}'.format(self.classes, incidence.shape))
-            
+        
         self.save_hypergraph(incidence, labels)
 
 
@@ -269,57 +318,125 @@ def regularize_with_categorical_features(data, weight=1):
                                                                  dtype=torch.float)))
         
 
-def normalized_incidence(data, sparse=False):
-    r"""Compute a numpy array holding D^{-1/2} H W^{1/2} B^{-1/2}, where H is 
-    the hypergraph incidence matrix. If data.hyperedge_index is given, it is
-    
-    given by data.x, D is the diagonal node
-    degree matrix, B is the diagonal hyperedge degree matrix, and W is the
-    optional diagonal hyperedge weight matrix given by data.hyperedge_weight.
+def incidence_factors(data):
+    r"""Return the hypergraph incidence matrix H as a double precision
+    scipy.sparse.csr_matrix, together with the diagonals of D^{-1/2} and
+    W^{1/2} B^{-1/2} as numpy arrays, cf. normalized_incidence. H is built
+    from data.hyperedge_index if given, otherwise it is assumed to be stored
+    in data.x.
     """
     
     if 'hyperedge_index' in data:
         col, row = data.hyperedge_index.cpu().numpy()
-        inc = sp.coo_matrix((np.ones(row.size), (row,col)), shape=(data.num_nodes, col.max()+1))
-        if not sparse:
-            inc = inc.toarray()
+        inc = sp.csr_matrix((np.ones(row.size), (row,col)), shape=(data.num_nodes, col.max()+1))
     else:
         # assume that data.x contains the dense incidence matrix
-        inc = data.x.cpu().numpy()
-        if sparse:
-            inc = sp.coo_matrix(inc)
+        inc = sp.csr_matrix(data.x.cpu().numpy(), dtype=np.float64)
         
     if 'hyperedge_weight' in data:
-        weights = data.hyperedge_weight.cpu().numpy()
+        weights = data.hyperedge_weight.cpu().numpy().astype(inc.dtype)
     else:
-        weights = np.ones(inc.shape[1], dtype=np.float)
+        weights = np.ones(inc.shape[1], dtype=inc.dtype)
     
     d = inc @ weights
     d_mask = d > 1e-4
     d[d_mask] = 1/np.sqrt(d[d_mask])
-    b = np.ones(inc.shape[0]) @ inc
-    b = np.sqrt(weights / b)
+    b = np.asarray(inc.sum(axis=0)).ravel()
+    b_mask = b > 0
+    b[b_mask] = np.sqrt(weights[b_mask] / b[b_mask])
     
-    if sparse:
-        for i in range(inc.nnz):
-            inc.data[i] *= d[inc.row[i]] * b[inc.col[i]]
-        return inc.tocsr()
-    else:
-        return d[:,np.newaxis] * inc * b
+    return inc, d, b
 
-def hypergraph_laplacian_decomposition(inc, num_ev=None, partial_svd=False, partial_tol=0):
-    r"""Return a (partial) eigen decomposition of the hypergraph Laplacian. If
-    num_ev is not None, only that many smallest eigenvalues are computed. If 
-    partial_svd is True, only a partial SVD is computed via scipy.linalg.svds
-    with tolerance given by the parameter partial_tol."""
-    
-    # TODO: get better heuristic of when to choose SVDS over SVD
-    if partial_svd and num_ev is not None:
-        U, sigma, _ = sp.linalg.svds(inc, num_ev, tol=partial_tol)
-    else:
-        U, sigma, _ = np.linalg.svd(inc, full_matrices=False)
+def normalized_incidence(data, sparse=False):
+    r"""Compute D^{-1/2} H W^{1/2} B^{-1/2}, where H is the hypergraph 
+    incidence matrix, D is the diagonal node degree matrix, B is the diagonal
+    hyperedge degree matrix, and W is the optional diagonal hyperedge weight
+    matrix given by data.hyperedge_weight. H is built from 
+    data.hyperedge_index if given, otherwise it is assumed to be stored in
+    data.x. The result is a scipy.sparse.csr_matrix if sparse is True, and a
+    numpy array otherwise.
+    """
+    
+    inc, d, b = incidence_factors(data)
+    
+    # scale the stored entries in one pass instead of broadcasting dense arrays
+    inc.data *= np.repeat(d, np.diff(inc.indptr)) * b[inc.indices]
+    
+    return inc if sparse else inc.toarray()
+
+def hypergraph_laplacian_decomposition(inc, num_ev=None, partial_svd=False, partial_tol=0, compute_uv=True,
+                                       row_scale=None, col_scale=None, overwrite_inc=False):
+    r"""Return a (partial) eigen decomposition of the hypergraph Laplacian 
+    I - inc inc^T. If row_scale or col_scale are given, inc stands for the 
+    matrix diag(row_scale) inc diag(col_scale), which is not formed 
+    explicitly on the Gram path. If num_ev is not None, only that many
+    smallest eigenvalues are computed. If inc is a scipy.sparse matrix or a
+    partial computation is requested by partial_svd, the eigenvalues are 
+    obtained from the small Gram matrix inc^T inc, whose size is the number
+    of hyperedges, and the eigenvectors are recovered by one matrix product.
+    In that case, partial_svd determines if scipy.sparse.linalg.eigsh is used
+    on the Gram matrix, with tolerance partial_tol. Otherwise, a full SVD of
+    the dense inc is computed, which may overwrite inc only if overwrite_inc
+    is True. In both cases, directions in the numerical kernel of inc (with
+    eigenvalue 1 of the Laplacian) are dropped, so fewer than num_ev, or 
+    fewer than the number of hyperedges if num_ev is None, eigenpairs may be
+    returned. If compute_uv is False, only the eigenvalues are computed and
+    returned."""
+    
+    if sp.issparse(inc) or (partial_svd and num_ev is not None):
+        # forming the Gram matrix squares the condition, so use double precision
+        inc = inc.astype(np.float64, copy=False)
+        if row_scale is None:
+            gram = inc.T @ inc
+        else:
+            gram = inc.T @ sp.diags(row_scale**2) @ inc
+        if sp.issparse(gram):
+            gram = gram.toarray()
+        if col_scale is not None:
+            gram = col_scale[:,np.newaxis] * gram * col_scale
+        m = gram.shape[0]
+        if partial_svd and num_ev is not None and num_ev < m/2:
+            res = sp.linalg.eigsh(gram, num_ev, which='LM', tol=partial_tol, return_eigenvectors=compute_uv)
+        elif compute_uv:
+            res = np.linalg.eigh(gram)
+        else:
+            res = np.linalg.eigvalsh(gram)
+        lam, V = res if compute_uv else (res, None)
+        
+        ind = np.argsort(lam)[::-1]
         if num_ev is not None:
-            U = U[:,:num_ev]
-            sigma = sigma[:num_ev]
+            ind = ind[:num_ev]
         
-    return 1 - sigma.astype(np.float32)**2, U.astype(np.float32)
+        # directions in the kernel of inc have no counterpart in its range
+        ind = ind[lam[ind] > m * np.finfo(lam.dtype).eps * lam.max()]
+        lam = lam[ind]
+        if not compute_uv:
+            return 1 - lam.astype(np.float32)
+        V = V[:,ind] / np.sqrt(lam)
+        if col_scale is not None:
+            V *= col_scale[:,np.newaxis]
+        U = inc @ V
+        if row_scale is not None:
+            U *= row_scale[:,np.newaxis]
+        return 1 - lam.astype(np.float32), U.astype(np.float32)
+    
+    # scaling creates a private copy of inc, which the SVD may then overwrite
+    if row_scale is not None:
+        inc = row_scale.astype(inc.dtype)[:,np.newaxis] * inc
+        overwrite_inc = True
+    if col_scale is not None:
+        inc = inc * col_scale.astype(inc.dtype)
+        overwrite_inc = True
+    res = scipy.linalg.svd(inc, full_matrices=False, compute_uv=compute_uv, overwrite_a=overwrite_inc, 
+                           check_finite=False, lapack_driver='gesdd')
+    U, sigma = (res[0], res[1]) if compute_uv else (None, res)
+    
+    if num_ev is not None:
+        sigma = sigma[:num_ev]
+    
+    # drop the kernel of inc like on the Gram path, sigma is sorted descendingly
+    if sigma.size > 0:
+        sigma = sigma[sigma**2 > inc.shape[1] * np.finfo(sigma.dtype).eps * sigma[0]**2]
+    if not compute_uv:
+        return 1 - sigma.astype(np.float32)**2
+    return 1 - sigma.astype(np.float32)**2, U[:,:sigma.size].astype(np.float32)